@@ -4,29 +4,232 @@ import os
 import time
 from playwright.async_api import async_playwright, Page
 
+# orjson 可选: 解析更快，缺失时回退到标准库
+# (orjson.JSONDecodeError 是 json.JSONDecodeError 的子类，两者可统一捕获)
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 # --- Configuration ---
 VERTEX_URL = "https://console.cloud.google.com/vertex-ai/studio/multimodal?mode=prompt&model=gemini-2.5-flash-lite-preview-09-2025"
 COOKIES_ENV_VAR = "GOOGLE_COOKIES"
+# 浏览器 Profile 持久化目录 (保留 HTTP 缓存 / Service Worker / V8 代码缓存)
+PROFILE_DIR = os.environ.get("VERTEX_PROFILE_DIR", "/tmp/vertex_profile")
+# 定时采集间隔 (45 分钟)；未抓到请求时的快速重试间隔
+HARVEST_INTERVAL = 2700
+HARVEST_RETRY_INTERVAL = 5
+# 跳转登录页后两次重试回到 Vertex 的最小间隔
+LOGIN_RETRY_INTERVAL = 60
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+# 与采集无关的静态资源: 在 Chromium 内按扩展名匹配后直接丢弃，其余请求不经过 Python
+_BLOCKED_RESOURCE_GLOB = "**/*.{png,jpg,jpeg,gif,webp,ico,svg,woff,woff2,ttf,otf,css,mp4,webm,mp3}"
+_BLOCKED_RESOURCE_TYPES = frozenset({"image", "font", "media", "stylesheet"})
+
+# 采集时只保留重放请求所需的 Header (main.py 直接使用这些 Header 转发请求)
+_WANTED_HEADERS = frozenset({
+    "authorization", "cookie", "content-type", "user-agent", "origin", "referer"
+})
+_WANTED_HEADER_PREFIXES = ("x-goog-", "x-client-")
+
+# batchGraphql 返回这些状态码时刷新页面
+# 400 经常对应 Bad Request (Recaptcha Token Invalid)，401/403 对应 Auth 失效
+_REFRESH_STATUSES = (400, 401, 403)
+
+# --- Selectors & JS snippets (固定字符串，V8 可直接命中编译缓存) ---
+_SEL_ERROR_DIALOG = 'div[role="dialog"]'
+_SEL_EDITOR = 'div[contenteditable="true"]'
+
+# 关键词匹配 (兼顾中英文)
+_EXHAUSTED_KEYWORDS = (
+    "Resources exhausted", "资源用尽", "资源耗尽",
+    "Quota exceeded", "配额已满", "Capacity reached",
+    "Something went wrong", "出错了" # 宽泛的错误也刷新重试
+)
+
+# 页面初始化脚本 (document_start 注入，常驻渲染进程):
+# DOM 变化时自动处理条款弹窗 (滚动 -> 勾选 "接受使用条款" -> 点击同意)，
+# 并关闭弹窗/浮层内的提示按钮 (Got it / OK / Close / Dismiss，含 "Sign in to continue..." 弹窗)。
+# 资源耗尽等错误弹窗保持不动，交给 perform_harvest 检测后刷新页面。
+_JS_AUTO_DISMISS = """
+(() => {
+    const EXHAUSTED = %s;
+    const LABELS = ["Close", "Dismiss"];
+    const TEXTS = ["Got it", "OK", "Dismiss"];
+    let scheduled = false;
+
+    const acceptTerms = () => {
+        const d = document.querySelector('div.mat-mdc-dialog-content');
+        if (!d) return false;
+        d.scrollTop = d.scrollHeight;
+
+        // 查找包含 Accept 或 接受 的 checkbox
+        const cb = Array.from(document.querySelectorAll('mat-checkbox')).find(c =>
+            c.innerText.includes("Accept terms of use") ||
+            c.innerText.includes("接受使用条款")
+        );
+        if (cb) {
+            // 尝试点击 input 元素，如果没有则点击 host；已勾选则不再重复点击
+            const input = cb.querySelector('input');
+            const checked = input ? input.checked : cb.classList.contains('mat-mdc-checkbox-checked');
+            if (!checked) {
+                (input || cb).click();
+                return true; // 勾选后稍后再点同意
+            }
+        }
+
+        const agreeBtn = Array.from(document.querySelectorAll('button')).find(b =>
+            (b.innerText.includes("Agree") || b.innerText.includes("同意")) &&
+            !b.innerText.includes("Disagree") // 防止误触
+        );
+        if (agreeBtn) {
+            agreeBtn.disabled = false; // 移除禁用状态
+            agreeBtn.click();
+        }
+        return false;
+    };
+
+    const closePopups = () => {
+        // 只处理弹窗/浮层中的按钮 (样式表被屏蔽，页面其他位置的隐藏按钮仍然有 client rects)
+        document.querySelectorAll('[role="dialog"] button, .cdk-overlay-container button').forEach(b => {
+            if (!b.getClientRects().length) return;
+            const text = b.innerText.trim();
+            if (!LABELS.includes(b.getAttribute('aria-label')) && !TEXTS.includes(text)) return;
+            const dialog = b.closest('[role="dialog"]');
+            if (dialog && EXHAUSTED.some(k => dialog.innerText.includes(k))) return;
+            b.click();
+        });
+    };
+
+    const schedule = (delay) => {
+        if (scheduled) return;
+        scheduled = true;
+        setTimeout(run, delay);
+    };
+
+    const run = () => {
+        scheduled = false;
+        try {
+            if (acceptTerms()) schedule(300);
+            closePopups();
+        } catch (e) {}
+    };
+
+    new MutationObserver(() => schedule(200)).observe(document, {childList: true, subtree: true});
+})();
+""" % json.dumps(_EXHAUSTED_KEYWORDS, ensure_ascii=False)
+
+# --- Shared Playwright driver ---
+# 多个 Harvester (多账号) 共用一个 Playwright 驱动进程，按引用计数在最后一个停止时关闭。
+# 每个账号仍使用独立的持久化 Profile (同一 user_data_dir 不能被多个 Chromium 同时打开)。
+# 锁延迟创建: Python 3.9 的 asyncio.Lock 会在构造时绑定事件循环
+_shared_pw_lock = None
+_shared_pw = None
+_shared_pw_refs = 0
+
+async def acquire_playwright():
+    """Returns the shared Playwright instance, starting it on first use."""
+    global _shared_pw_lock, _shared_pw, _shared_pw_refs
+    if _shared_pw_lock is None:
+        _shared_pw_lock = asyncio.Lock()
+    async with _shared_pw_lock:
+        if _shared_pw is None:
+            _shared_pw = await async_playwright().start()
+        _shared_pw_refs += 1
+        return _shared_pw
+
+async def release_playwright():
+    """Drops one reference to the shared Playwright instance, stopping it when unused."""
+    global _shared_pw, _shared_pw_refs
+    async with _shared_pw_lock:
+        _shared_pw_refs -= 1
+        if _shared_pw_refs == 0 and _shared_pw:
+            pw, _shared_pw = _shared_pw, None
+            await pw.stop()
+
+def parse_cookies(raw_cookies):
+    """Parses an exported cookie JSON array. Returns None if it is invalid."""
+    try:
+        cookies = json_loads(raw_cookies)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(cookies, list):
+        return None
+    # 每项都必须能被 context.add_cookies 接受: name/value 以及 url 或 domain
+    for cookie in cookies:
+        if not isinstance(cookie, dict) or "name" not in cookie or "value" not in cookie:
+            return None
+        if "url" not in cookie and "domain" not in cookie:
+            return None
+    return cookies
+
+def is_generate_request(request):
+    """True for the batchGraphql POST that carries a (Stream)GenerateContent call."""
+    if "batchGraphql" not in request.url or request.method != "POST":
+        return False
+    try:
+        post_data = request.post_data
+    except Exception:
+        return False
+    # 只要是生成内容的请求，都尝试抓取
+    return bool(post_data) and ("StreamGenerateContent" in post_data or "generateContent" in post_data)
 
 class CloudHarvester:
-    def __init__(self, cred_manager):
+    # 同一 user_data_dir 不能被多个 Chromium 同时打开: 未指定时按实例编号分配独立目录
+    _instance_count = 0
+
+    def __init__(self, cred_manager, profile_dir=None):
         self.cred_manager = cred_manager
-        self.browser = None
+        if profile_dir is None:
+            CloudHarvester._instance_count += 1
+            n = CloudHarvester._instance_count
+            profile_dir = PROFILE_DIR if n == 1 else f"{PROFILE_DIR}_{n}"
+        self.profile_dir = profile_dir
+        self.pw = None
+        self.context = None
         self.page = None
+        self._response_watcher = None
+        self._capture_tasks = set()
         self.is_running = False
         self.last_harvest_time = 0
-        self.current_cookies = os.environ.get(COOKIES_ENV_VAR)
-        self.restart_requested = False
-        
-        # New: 状态标记
-        self.refresh_needed = False
+        # Cookies 在更新时解析一次，重启时直接复用解析结果
+        self.current_cookies = None
+        env_cookies = os.environ.get(COOKIES_ENV_VAR)
+        if env_cookies:
+            self.current_cookies = parse_cookies(env_cookies)
+            if self.current_cookies is None:
+                print(f"❌ Cloud Harvester: Invalid JSON in {COOKIES_ENV_VAR}.")
         self.last_login_retry_time = 0
+        # 页面 URL/标题缓存 (由导航事件更新，避免每次都走 CDP 查询)
+        self._current_url = ""
+        self._current_title = ""
+        
+        # 状态事件: 由回调触发，主循环阻塞等待，不再轮询
+        self._refresh_evt = asyncio.Event()
+        self._restart_evt = asyncio.Event()
+        self._login_fail_evt = asyncio.Event()
+        # 页面崩溃/关闭或浏览器断开: 退出内层循环，由外层循环重新启动浏览器
+        self._crash_evt = asyncio.Event()
+        # 刷新进行中 (重载直到编辑器挂载) 时持有，期间到达的错误响应不再重复触发刷新
+        self._refresh_sem = asyncio.Semaphore(1)
+        # 定时采集: 由 loop.call_later 在到期时触发，任意时刻只保留一个定时器
+        self._harvest_evt = asyncio.Event()
+        self._harvest_handle = None
+        # Cookies 过期后定时重试回到 Vertex (LOGIN_RETRY_INTERVAL)
+        self._login_retry_handle = None
 
     async def update_cookies(self, new_cookies_json):
-        """Updates cookies and triggers a browser restart."""
-        print("🍪 Cloud Harvester: Received new cookies. Scheduling restart...")
-        self.current_cookies = new_cookies_json
-        self.restart_requested = True
+        """Updates cookies and reloads the page with them. Returns False if the JSON is invalid."""
+        cookies = parse_cookies(new_cookies_json)
+        if cookies is None:
+            print("❌ Cloud Harvester: Invalid JSON in cookies.")
+            return False
+        print("🍪 Cloud Harvester: Received new cookies. Scheduling reload...")
+        self.current_cookies = cookies
+        self._restart_evt.set()
+        return True
 
     async def start(self):
         """Starts the browser and the harvesting loop."""
@@ -36,261 +239,382 @@ class CloudHarvester:
         print("☁️ Cloud Harvester: Starting...")
         self.is_running = True
         
-        while self.is_running:
-            try:
-                async with async_playwright() as p:
-                    self.browser = await p.chromium.launch(headless=True, args=['--no-sandbox', '--disable-setuid-sandbox'])
-                    context = await self.browser.new_context(
-                        user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-                    )
-                    
-                    if self.current_cookies:
-                        try:
-                            cookies = json.loads(self.current_cookies)
-                            await context.add_cookies(cookies)
-                            print(f"🍪 Cloud Harvester: Loaded {len(cookies)} cookies.")
-                        except json.JSONDecodeError:
-                            print("❌ Cloud Harvester: Invalid JSON in cookies.")
-                            self.current_cookies = None # Reset invalid cookies
-                            await asyncio.sleep(10)
-                            continue
+        try:
+            while self.is_running:
+                try:
+                    # 初始化: Chromium、Context 和页面只创建一次，仅在出错后重建
+                    if not self.context:
+                        await self.launch_browser()
+                    context = self.context
+
+                    await self.apply_cookies()
 
-                    self.page = await context.new_page()
+                    self.page = context.pages[0] if context.pages else await context.new_page()
                     
-                    # 1. 拦截请求
-                    await self.page.route("**/*", self.handle_route)
-                    # 2. 监听响应 (检测 401/403)
-                    self.page.on("response", self.handle_response)
+                    # 1. 监听请求 (只读观察，无需 route 拦截/continue 往返)
+                    self.page.on("request", self.handle_request)
+                    # 2. 等待 batchGraphql 的 400/401/403 响应 (后台任务)
+                    self._response_watcher = asyncio.create_task(self.watch_responses(self.page))
+                    # 3. 监听导航与加载 (缓存 URL/标题，检测登录页跳转)
+                    self._current_url = ""
+                    self._current_title = ""
+                    self.page.on("framenavigated", self.handle_frame_navigated)
+                    self.page.on("load", self.handle_page_load)
+                    # 4. 监听页面崩溃/关闭
+                    self.page.on("crash", self.handle_page_gone)
+                    self.page.on("close", self.handle_page_gone)
+
+                    self._crash_evt.clear()
+                    self._restart_evt.clear()
+                    self._refresh_evt.clear()
+                    self._login_fail_evt.clear()
+                    if self.cred_manager.latest_harvest:
+                        self.schedule_harvest(max(0, HARVEST_INTERVAL - (time.time() - self.last_harvest_time)))
+                    else:
+                        self.schedule_harvest(0)
                     
                     print(f"☁️ Cloud Harvester: Navigating to {VERTEX_URL}...")
                     try:
-                        await self.page.goto(VERTEX_URL, timeout=60000, wait_until="domcontentloaded")
+                        await self.page.goto(VERTEX_URL, timeout=30000, wait_until="commit")
                     except Exception as e:
                         print(f"❌ Cloud Harvester: Navigation failed: {e}")
                     
-                    self.restart_requested = False
-                    self.refresh_needed = False
-                    
-                    # Inner Loop
-                    while self.is_running and not self.restart_requested:
+                    # Inner Loop: 等待事件 (含定时采集)，先到先处理
+                    while self.is_running:
+                        waiters = [
+                            asyncio.create_task(evt.wait())
+                            for evt in (self._crash_evt, self._refresh_evt, self._restart_evt, self._login_fail_evt, self._harvest_evt)
+                        ]
+                        try:
+                            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+                        finally:
+                            for task in waiters:
+                                task.cancel()
+
+                        if not self.is_running:
+                            break
+
+                        if self._crash_evt.is_set() or self.context is None or self.page.is_closed():
+                            print("💥 Cloud Harvester: Page crashed or browser disconnected. Relaunching...")
+                            self._crash_evt.set()
+                            break
+
+                        # 更换 Cookies: 保留 Context 与页面 (已编译的 JS / 连接)，只替换 Cookies 后重新打开 Vertex
+                        # (用 goto 而不是 reload: 页面可能停在登录页)
+                        if self._restart_evt.is_set():
+                            print("♻️ Cloud Harvester: Reloading with new cookies...")
+                            self._restart_evt.clear()
+                            self._refresh_evt.clear()
+                            self._login_fail_evt.clear()
+                            self.cancel_login_retry()
+                            self.last_login_retry_time = 0
+                            try:
+                                await self.apply_cookies()
+                                await self.page.goto(VERTEX_URL, wait_until="commit", timeout=30000)
+                            except Exception as e:
+                                print(f"⚠️ Cloud Harvester: Cookie reload failed: {e}")
+                            self.schedule_harvest(0)
+                            continue
                         
                         # A. 自动刷新检测 (Recaptcha token invalid / 401 / 403 / Resource Exhausted)
-                        if self.refresh_needed:
+                        if self._refresh_evt.is_set():
                             print("♻️ Cloud Harvester: Token invalid, expired, or resource exhausted. Refreshing page...")
+                            self._refresh_evt.clear()
+                            self.cancel_harvest()
                             try:
-                                await self.page.reload(wait_until="domcontentloaded")
-                                self.refresh_needed = False
-                                await asyncio.sleep(5)
-                                await self.perform_harvest() # 立即尝试交互
+                                # reload 在 commit 时就返回，新页面自身的 400/401 在加载过程中才到达，
+                                # 因此一直持有到编辑器挂载为止
+                                async with self._refresh_sem:
+                                    await self.page.reload(wait_until="commit", timeout=30000)
+                                    try:
+                                        await self.page.wait_for_selector(_SEL_EDITOR, state="attached", timeout=15000)
+                                    except Exception as e:
+                                        print(f"   - Editor not attached yet: {e}")
+                                await self.run_scheduled_harvest() # 立即尝试交互
                             except Exception as e:
                                 print(f"⚠️ Refresh failed: {e}")
+                                self.schedule_harvest(HARVEST_RETRY_INTERVAL)
                             continue
 
                         # B. 登录页跳转检测
-                        if "accounts.google.com" in self.page.url or "Sign in" in await self.page.title():
+                        if self._login_fail_evt.is_set():
+                            self._login_fail_evt.clear()
+                            if not self.is_login_page():
+                                continue # 过期信号: 页面已回到 Vertex
+                            self.cancel_login_retry()
                             current_time = time.time()
-                            if current_time - self.last_login_retry_time > 60:
+                            if current_time - self.last_login_retry_time > LOGIN_RETRY_INTERVAL:
                                 print("⚠️ Cloud Harvester: Redirected to Login. Trying to navigate back (Retry)...")
                                 self.last_login_retry_time = current_time
                                 try:
-                                    await self.page.goto(VERTEX_URL, wait_until="domcontentloaded")
-                                    await asyncio.sleep(5)
-                                    continue 
-                                except: pass
+                                    await self.page.goto(VERTEX_URL, wait_until="commit", timeout=30000)
+                                except Exception as e:
+                                    print(f"⚠️ Cloud Harvester: Navigation failed: {e}")
+                                # 若再次跳转到登录页，会在下一次登录事件中取消
+                                self.schedule_harvest(0)
+                                continue
                             else:
-                                print("❌ Cloud Harvester: Cookies Expired (Login Page detected).")
-                                break 
+                                # 暂停定时采集，到期后再次重试 (或等待 /admin 更新 Cookies)
+                                delay = LOGIN_RETRY_INTERVAL - (current_time - self.last_login_retry_time) + 1
+                                print(f"❌ Cloud Harvester: Cookies Expired (Login Page detected). Retrying in {int(delay)}s...")
+                                self.cancel_harvest()
+                                self._login_retry_handle = asyncio.get_running_loop().call_later(delay, self._login_fail_evt.set)
+                                continue
 
                         # C. 定时采集
-                        if time.time() - self.last_harvest_time > 2700 or not self.cred_manager.latest_harvest:
-                            await self.perform_harvest()
-                        
-                        await asyncio.sleep(5)
+                        if self._harvest_evt.is_set():
+                            await self.run_scheduled_harvest()
                     
-                    await self.browser.close()
-                    if self.restart_requested:
-                        print("♻️ Cloud Harvester: Restarting with new cookies...")
+                    self.cancel_harvest()
+                    self.cancel_login_retry()
+                    await self.close_page()
+                    if self._crash_evt.is_set():
+                        # 关闭残留的浏览器，下一轮循环调用 launch_browser() 重新启动
+                        await self.close_context()
 
-            except Exception as e:
-                print(f"❌ Cloud Harvester Error: {e}")
-                await asyncio.sleep(10)
+                except Exception as e:
+                    print(f"❌ Cloud Harvester Error: {e}")
+                    # 避免下一轮复用同一页面时重复注册监听
+                    try:
+                        await self.close_page()
+                    except Exception as close_err:
+                        print(f"⚠️ Cloud Harvester: Page close failed: {close_err}")
+                    await asyncio.sleep(10)
+        finally:
+            self.cancel_harvest()
+            self.cancel_login_retry()
+            await self.close_browser()
         
         print("☁️ Cloud Harvester: Stopped.")
 
-    async def handle_response(self, response):
-        try:
-            # 检测接口错误，如果 Recaptcha 失效通常也会导致接口报错
-            if "batchGraphql" in response.url:
-                if response.status in [400, 401, 403]:
-                    # 400 经常对应 Bad Request (Recaptcha Token Invalid)
-                    # 401/403 对应 Auth 失效
-                    print(f"⚠️ Cloud Harvester: API returned {response.status}. Marking for refresh.")
-                    self.refresh_needed = True
-        except:
-            pass
-
-    async def handle_route(self, route):
-        request = route.request
-        if "batchGraphql" in request.url and request.method == "POST":
+    async def apply_cookies(self):
+        """Replaces the context cookies with the current cookie set."""
+        # Profile 会把上一轮的 Cookies 落盘，先清空再加载当前 Cookies
+        await self.context.clear_cookies()
+        if self.current_cookies:
+            await self.context.add_cookies(self.current_cookies)
+            print(f"🍪 Cloud Harvester: Loaded {len(self.current_cookies)} cookies.")
+
+    def schedule_harvest(self, delay):
+        """Schedules the next harvest, replacing any pending timer."""
+        self.cancel_harvest()
+        self._harvest_handle = asyncio.get_running_loop().call_later(delay, self._harvest_evt.set)
+
+    def cancel_harvest(self):
+        if self._harvest_handle:
+            self._harvest_handle.cancel()
+            self._harvest_handle = None
+        self._harvest_evt.clear()
+
+    def cancel_login_retry(self):
+        if self._login_retry_handle:
+            self._login_retry_handle.cancel()
+            self._login_retry_handle = None
+
+    async def run_scheduled_harvest(self):
+        """Runs one harvest; retries shortly if no request was captured."""
+        self._harvest_evt.clear()
+        started = time.time()
+        await self.perform_harvest()
+        if self.last_harvest_time < started:
+            self.schedule_harvest(HARVEST_RETRY_INTERVAL)
+
+    async def launch_browser(self):
+        """Launches (or relaunches) Chromium with a persistent on-disk profile."""
+        # 重启时只关闭 Chromium，保留共享的 Playwright 驱动
+        await self.close_context()
+        print(f"🌐 Cloud Harvester: Launching Chromium (profile: {self.profile_dir})...")
+        if not self.pw:
+            self.pw = await acquire_playwright()
+        self.context = await self.pw.chromium.launch_persistent_context(
+            self.profile_dir,
+            headless=True,
+            args=['--no-sandbox', '--disable-setuid-sandbox'],
+            user_agent=USER_AGENT
+        )
+        # 浏览器意外退出时，下一轮循环重新启动
+        self.context.on("close", self.handle_context_close)
+        # 条款/提示弹窗在页面内自动关闭，每次导航都会重新注入
+        await self.context.add_init_script(_JS_AUTO_DISMISS)
+        # 屏蔽图片/字体/媒体/样式表，只保留 DOM 和 XHR
+        await self.context.route(_BLOCKED_RESOURCE_GLOB, self.handle_blocked_route)
+
+    def handle_context_close(self, context):
+        if context is self.context:
+            self.context = None
+            self._crash_evt.set()
+
+    def handle_page_gone(self, page):
+        # close_page() 会先置空 self.page，主动关闭不会触发重启
+        if page is self.page:
+            self._crash_evt.set()
+
+    async def close_context(self):
+        """Closes Chromium (the persistent context)."""
+        if self.context:
+            context, self.context = self.context, None
             try:
-                post_data = request.post_data
-                # 只要是生成内容的请求，都尝试抓取
-                if post_data and ("StreamGenerateContent" in post_data or "generateContent" in post_data):
-                    print("🎯 Cloud Harvester: Captured Target Request!")
-                    harvest_data = {
-                        "url": request.url,
-                        "method": request.method,
-                        "headers": request.headers,
-                        "body": post_data
-                    }
-                    self.cred_manager.update(harvest_data)
-                    self.last_harvest_time = time.time()
-                    self.last_login_retry_time = 0 
-                    
-                    # Signal that the refresh sequence is complete
-                    print("☁️ Cloud Harvester: Signaling refresh complete.")
-                    self.cred_manager.refresh_complete_event.set()
-                    
+                await context.close()
+            except Exception as e:
+                print(f"⚠️ Cloud Harvester: Browser close failed: {e}")
+
+    async def close_browser(self):
+        """Closes Chromium and releases the shared Playwright driver."""
+        await self.close_context()
+        if self.pw:
+            self.pw = None
+            try:
+                await release_playwright()
+            except Exception as e:
+                print(f"⚠️ Cloud Harvester: Playwright stop failed: {e}")
+
+    async def close_page(self):
+        """Stops the response watcher and closes the current page."""
+        if self._response_watcher:
+            self._response_watcher.cancel()
+            self._response_watcher = None
+        if self.page:
+            page, self.page = self.page, None
+            try:
+                await page.close()
+            except Exception as e:
+                print(f"⚠️ Cloud Harvester: Page close failed: {e}")
+
+    async def watch_responses(self, page):
+        """Flags a refresh whenever batchGraphql returns an auth/recaptcha error."""
+        # 检测接口错误，如果 Recaptcha 失效通常也会导致接口报错
+        while not page.is_closed():
+            try:
+                response = await page.wait_for_event(
+                    "response",
+                    predicate=lambda r: "batchGraphql" in r.url and r.status in _REFRESH_STATUSES,
+                    timeout=0
+                )
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                print(f"⚠️ Cloud Harvester: Error analyzing request: {e}")
-        await route.continue_()
+                # 页面崩溃或被关闭: 若仍是当前页面，通知主循环重启浏览器
+                if page is self.page:
+                    print(f"⚠️ Cloud Harvester: Response watcher stopped: {e}")
+                    self._crash_evt.set()
+                return
+            if self._refresh_sem.locked():
+                continue # 正在刷新，忽略重载过程中的错误响应
+            print(f"⚠️ Cloud Harvester: API returned {response.status}. Marking for refresh.")
+            self._refresh_evt.set()
+
+    def is_login_page(self):
+        return "accounts.google.com" in self._current_url or "Sign in" in self._current_title
+
+    def handle_frame_navigated(self, frame):
+        if not self.page or frame is not self.page.main_frame:
+            return
+        self._current_url = frame.url
+        self._current_title = ""
+        if self.is_login_page():
+            self._login_fail_evt.set()
+
+    async def handle_page_load(self, page):
+        try:
+            self._current_title = await page.title()
+        except Exception as e:
+            print(f"⚠️ Cloud Harvester: Title check failed: {e}")
+            return
+        if self.is_login_page():
+            self._login_fail_evt.set()
+
+    async def handle_blocked_route(self, route):
+        if route.request.resource_type in _BLOCKED_RESOURCE_TYPES:
+            await route.abort()
+        else:
+            await route.continue_()
+
+    def handle_request(self, request):
+        # 同步监听: 其余子资源请求直接返回，不创建任何 Task
+        if not is_generate_request(request):
+            return
+        # 立即记录采集时间，run_scheduled_harvest 返回时即可判断是否命中
+        self.last_harvest_time = time.time()
+        self.schedule_harvest(HARVEST_INTERVAL)
+        self.last_login_retry_time = 0
+        task = asyncio.create_task(self.capture_request(request))
+        self._capture_tasks.add(task)
+        task.add_done_callback(self._capture_tasks.discard)
+
+    async def capture_request(self, request):
+        try:
+            post_data = request.post_data
+            print("🎯 Cloud Harvester: Captured Target Request!")
+            harvest_data = {
+                "url": request.url,
+                "method": request.method,
+                "headers": {
+                    k: v for k, v in request.headers.items()
+                    if k.lower() in _WANTED_HEADERS or k.lower().startswith(_WANTED_HEADER_PREFIXES)
+                },
+                "body": post_data
+            }
+            # 凭证写盘在线程池中进行，事件通知仍在事件循环线程
+            await self.cred_manager.update_async(harvest_data)
+            # Signal that the refresh sequence is complete
+            print("☁️ Cloud Harvester: Signaling refresh complete.")
+            self.cred_manager.refresh_complete_event.set()
+            
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Cloud Harvester: Error analyzing request: {e}")
 
     async def perform_harvest(self):
         print("🤖 Cloud Harvester: Attempting to trigger request...")
         if not self.page: return
 
         try:
+            # 导航只等到 commit，这里以编辑器挂载作为页面就绪的同步点
+            try:
+                await self.page.wait_for_selector(_SEL_EDITOR, state="attached", timeout=15000)
+            except Exception as e:
+                print(f"   - Editor not attached yet: {e}")
+
             # ============================================================
             # 0. 检测资源耗尽弹窗 (Resource Exhausted)
             # ============================================================
             try:
                 # 检测常见的错误弹窗容器
-                dialog_selector = 'div[role="dialog"]'
-                if await self.page.is_visible(dialog_selector):
-                    dialog_text = await self.page.inner_text(dialog_selector)
-                    # 关键词匹配 (兼顾中英文)
-                    exhausted_keywords = [
-                        "Resources exhausted", "资源用尽", "资源耗尽", 
-                        "Quota exceeded", "配额已满", "Capacity reached",
-                        "Something went wrong", "出错了" # 宽泛的错误也刷新重试
-                    ]
-                    
-                    if any(k in dialog_text for k in exhausted_keywords):
+                if await self.page.is_visible(_SEL_ERROR_DIALOG):
+                    dialog_text = await self.page.inner_text(_SEL_ERROR_DIALOG)
+                    if any(k in dialog_text for k in _EXHAUSTED_KEYWORDS):
                         print(f"⚠️ Cloud Harvester: Error dialog detected ('{dialog_text[:30]}...'). Marking for refresh.")
-                        self.refresh_needed = True
+                        self._refresh_evt.set()
                         return
             except Exception as e:
                 print(f"   - Resource check failed: {e}")
 
-            # ============================================================
-            # 1. 处理条款弹窗 (修复了 SyntaxError)
-            # 使用原生 JS 遍历元素，替代不兼容的 Selector
-            # ============================================================
-            dialog_content = 'div.mat-mdc-dialog-content'
-            if await self.page.is_visible(dialog_content):
-                print("🧹 Cloud Harvester: Terms Dialog detected. Handling via JS...")
-                
-                # 1.1 滚动 (防止点击被遮挡)
-                await self.page.evaluate(f"""
-                    const d = document.querySelector('{dialog_content}');
-                    if(d) d.scrollTop = d.scrollHeight;
-                """)
-                await asyncio.sleep(0.5)
-
-                # 1.2 查找并勾选 (原生 JS 查找包含文本的元素)
-                await self.page.evaluate("""
-                    // 查找包含 Accept 或 接受 的 checkbox
-                    const checkboxes = Array.from(document.querySelectorAll('mat-checkbox'));
-                    const targetCb = checkboxes.find(cb => 
-                        cb.innerText.includes("Accept terms of use") || 
-                        cb.innerText.includes("接受使用条款")
-                    );
-                    
-                    if (targetCb) {
-                        // 尝试点击 input 元素，如果没有则点击 host
-                        const input = targetCb.querySelector('input');
-                        if (input) input.click();
-                        else targetCb.click();
-                    }
-                """)
-                
-                print("   - Checkbox ticked (if found). Waiting for button...")
-                await asyncio.sleep(1.5)
-
-                # 1.3 查找并点击同意按钮 (原生 JS)
-                await self.page.evaluate("""
-                    const buttons = Array.from(document.querySelectorAll('button'));
-                    const agreeBtn = buttons.find(b => 
-                        (b.innerText.includes("Agree") || b.innerText.includes("同意")) && 
-                        !b.innerText.includes("Disagree") // 防止误触
-                    );
-                    
-                    if (agreeBtn) {
-                        agreeBtn.disabled = false; // 移除禁用状态
-                        agreeBtn.click();
-                    }
-                """)
-                
-                # 等待弹窗消失
-                try:
-                    await self.page.wait_for_selector(dialog_content, state='hidden', timeout=3000)
-                    print("   - Dialog closed.")
-                except: pass
-
-            # 处理普通提示弹窗 (Got it / Close / Dismiss)
-            # 这里使用 Playwright 选择器是安全的，因为这些是标准 CSS
-            popup_selectors = [
-                'button[aria-label="Close"]',
-                'button[aria-label="Dismiss"]',
-                'button:has-text("Got it")',
-                'button:has-text("OK")',
-                'button:has-text("Dismiss")' # 针对 "Sign in to continue..." 弹窗
-            ]
-            
-            # 特别检测 "Sign in to continue using Vertex AI" 弹窗
-            try:
-                signin_dialog_text = "Sign in to continue using Vertex AI"
-                if await self.page.is_visible(f'text="{signin_dialog_text}"'):
-                    print(f"⚠️ Cloud Harvester: '{signin_dialog_text}' detected. Clicking Dismiss...")
-                    # 尝试点击 Dismiss 按钮
-                    await self.page.click('button:has-text("Dismiss")')
-                    await asyncio.sleep(1)
-            except: pass
-
-            for selector in popup_selectors:
-                try:
-                    if await self.page.is_visible(selector):
-                        await self.page.click(selector)
-                except: pass
+            # 条款弹窗与普通提示弹窗由 _JS_AUTO_DISMISS 在页面内自动处理
 
             # ============================================================
             # 2. 发送文本 "Hello"
             # ============================================================
-            editor_selector = 'div[contenteditable="true"]'
-            
             print("⏳ Cloud Harvester: Waiting for editor...")
             try:
                 # 等待编辑器出现
-                await self.page.wait_for_selector(editor_selector, state="visible", timeout=8000)
+                await self.page.wait_for_selector(_SEL_EDITOR, state="visible", timeout=15000)
                 
-                # 确保焦点
-                await self.page.click(editor_selector, force=True)
-                
-                # 清空并输入
-                await self.page.evaluate(f"document.querySelector('{editor_selector}').innerText = ''")
-                await self.page.fill(editor_selector, "Hello")
-                await asyncio.sleep(0.5)
+                # 聚焦后用键盘全选删除，再一次性插入文本 (无需 JS 清空/逐键输入)
+                await self.page.focus(_SEL_EDITOR)
+                await self.page.keyboard.press("Control+A")
+                await self.page.keyboard.press("Delete")
+                await self.page.keyboard.insert_text("Hello")
                 
                 print("🚀 Cloud Harvester: Sending 'Hello'...")
-                await self.page.press(editor_selector, "Enter")
-                
-                # 等待网络请求被 handle_route 捕获
-                await asyncio.sleep(5)
+                # 等到目标请求真正发出即返回 (由 handle_request 捕获)
+                async with self.page.expect_request(is_generate_request, timeout=10000):
+                    await self.page.keyboard.press("Enter")
                 
             except Exception as e:
                 print(f"⚠️ Editor interaction skipped: {e}")
                 # 如果找不到编辑器，可能是页面还在加载，或者需要刷新
-                # 可以在这里不做处理，依靠 handle_response 来决定是否刷新
+                # 可以在这里不做处理，依靠 watch_responses 来决定是否刷新
 
         except Exception as e:
             print(f"❌ Cloud Harvester: Interaction failed: {e}")
@@ -6,6 +6,7 @@ import httpx
 import uvicorn
 import sys
 import os
+import threading
 from fastapi import FastAPI, Request, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
@@ -62,6 +63,10 @@ class CredentialManager:
         self._refresh_event = None
         self._refresh_complete_event = None
         self._refresh_lock = None
+        # 写盘可能来自线程池: 加锁串行化，并丢弃过期的快照
+        self._save_lock = threading.Lock()
+        self._save_version = 0
+        self._saved_version = 0
         self.load_from_disk()
 
     @property
@@ -96,24 +101,57 @@ class CredentialManager:
         except Exception as e:
             print(f"⚠️ Error loading credentials: {e}")
 
-    def save_to_disk(self):
+    def _snapshot(self):
+        """Serializes the current credentials. Must run on the event loop thread."""
         try:
-            with open(self.filepath, 'w', encoding='utf-8') as f:
-                json.dump({
-                    'harvest': self.latest_harvest,
-                    'timestamp': self.last_updated
-                }, f, indent=2)
-            print(f"💾 Credentials saved to {self.filepath}")
+            payload = json.dumps({
+                'harvest': self.latest_harvest,
+                'timestamp': self.last_updated
+            }, indent=2)
         except Exception as e:
             print(f"⚠️ Error saving credentials: {e}")
+            return None
+        self._save_version += 1
+        return payload, self._save_version
+
+    def _write_snapshot(self, snapshot):
+        """Atomically replaces the credentials file. Safe to call from a worker thread."""
+        if not snapshot:
+            return
+        payload, version = snapshot
+        with self._save_lock:
+            if version < self._saved_version:
+                return # 已有更新的快照写入
+            tmp_path = f"{self.filepath}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(payload)
+                os.replace(tmp_path, self.filepath)
+                self._saved_version = version
+                print(f"💾 Credentials saved to {self.filepath}")
+            except Exception as e:
+                print(f"⚠️ Error saving credentials: {e}")
 
-    def update(self, data: Dict[str, Any]):
+    def save_to_disk(self):
+        self._write_snapshot(self._snapshot())
+
+    def _set_harvest(self, data: Dict[str, Any]):
         self.latest_harvest = data
         self.last_updated = time.time()
         print(f"🔄 Credentials updated at {time.strftime('%H:%M:%S')}")
+
+    def update(self, data: Dict[str, Any]):
+        self._set_harvest(data)
         self.save_to_disk()
         self.refresh_event.set() # Unblock credential waiting requests
 
+    async def update_async(self, data: Dict[str, Any]):
+        """Same as update(), but writes to disk on a worker thread."""
+        self._set_harvest(data)
+        snapshot = self._snapshot()
+        self.refresh_event.set() # Unblock credential waiting requests
+        await asyncio.to_thread(self._write_snapshot, snapshot)
+
     def update_token(self, token: str):
         if self.latest_harvest and 'headers' in self.latest_harvest:
             # Debug: Print old token prefix
@@ -965,16 +1003,11 @@ async def update_cookies(request: Request):
     if not cookies:
         return StreamingResponse(iter(["<h1>❌ No cookies provided</h1>"]), media_type="text/html", status_code=400)
     
-    # Validate JSON
-    try:
-        json.loads(cookies)
-    except json.JSONDecodeError:
-        return StreamingResponse(iter(["<h1>❌ Invalid JSON format</h1>"]), media_type="text/html", status_code=400)
-        
-    # Update Harvester
+    # Update Harvester (parses and validates the cookie JSON)
     if 'harvester' in globals() and harvester:
-        await harvester.update_cookies(cookies)
-        return StreamingResponse(iter(["<h1>✅ Cookies Updated! Harvester restarting...</h1><a href='/admin'>Back</a>"]), media_type="text/html")
+        if not await harvester.update_cookies(cookies):
+            return StreamingResponse(iter(["<h1>❌ Invalid JSON format</h1>"]), media_type="text/html", status_code=400)
+        return StreamingResponse(iter(["<h1>✅ Cookies Updated! Harvester reloading...</h1><a href='/admin'>Back</a>"]), media_type="text/html")
     else:
         return StreamingResponse(iter(["<h1>⚠️ Cloud Harvester is not running. (Did you set GOOGLE_COOKIES env var?)</h1>"]), media_type="text/html")
 